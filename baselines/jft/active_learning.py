@@ -37,6 +37,7 @@ from functools import partial  # pylint: disable=g-importing-member standard use
 import logging
 import math
 import multiprocessing
+import os
 
 from absl import app
 from absl import flags
@@ -47,6 +48,7 @@ from clu import preprocess_spec
 import flax
 import flax.jax_utils as flax_utils
 import jax
+from jax.experimental.compilation_cache import compilation_cache
 import jax.numpy as jnp
 from ml_collections.config_flags import config_flags
 import numpy as np
@@ -61,7 +63,6 @@ import deterministic_utils  # local file import from baselines.jft
 import input_utils  # local file import from baselines.jft
 import ood_utils  # local file import from baselines.jft
 import preprocess_utils  # local file import from baselines.jft
-import train_utils  # local file import from baselines.jft
 config_flags.DEFINE_config_file(
     'config', None, 'Training configuration.', lock_config=True)
 flags.DEFINE_string('output_dir', default=None, help='Work unit directory.')
@@ -74,43 +75,64 @@ flags.DEFINE_string('tpu', None,
 
 FLAGS = flags.FLAGS
 
-NINF_SCORE = float('-inf')
 
+def start_epoch(ds, prefetch_to_device=1):
+  """Returns an iterator over one epoch of `ds`.
 
-def get_ids_logits_masks(*,
-                         model,
-                         opt_repl,
-                         ds,
-                         use_pre_logits=False,
-                         average_logits=True,
-                         prefetch_to_device=1,
-                         config=None):
-  """Obtain (pre) logits for each datapoint.
+  Args:
+    ds: a dataset, or a function that returns an iterator over the next epoch of
+      a long-lived iterator (see `input_utils.start_epoch_input_pipeline`).
+    prefetch_to_device: how many batches to prefetch if `ds` is a dataset.
 
-  This can be then used to compute entropies, and so on.
+  Returns:
+    an iterator over the batches of one epoch.
+  """
+  if callable(ds):
+    return ds()
+  return input_utils.start_input_pipeline(ds, prefetch_to_device)
+
+
+def create_pool_inference_fn(*,
+                             model,
+                             use_pre_logits=False,
+                             average_logits=True,
+                             score_fn=None,
+                             config=None):
+  """Creates the forward pass for the pool set.
+
+  The acquisition method is fixed for a run, so this is created (and compiled)
+  once, specialized to the outputs that the acquisition method needs.
 
   Args:
     model: a initialized model.
-    opt_repl: an optimizer with parameters.
-    ds: a dataset.
     use_pre_logits: if True, return pre logit instead of logit
     average_logits: if True, average the logits.
-    prefetch_to_device: how many batches to prefix
-    config: experiment config.
+    score_fn: if given, a function that maps the outputs of a batch (on a
+      single device) to scores, which are returned instead of the outputs. This
+      is fused into the forward pass, such that only the scores are copied to
+      host.
+    config: experiment config. If `config.pool_inference_bfloat16` is set,
+      matmuls run in bfloat16 precision, and pre logits are returned in
+      bfloat16.
 
   Returns:
-    a tuple of jnp arrays of ids, logits, labels and masks.
+    a pmapped function that maps parameters and images to (pre) logits or
+    scores. Without a score_fn, per-member logits (i.e. not average_logits) have
+    the ensemble as first dimension (per device).
   """
+  use_bfloat16 = config and config.get('pool_inference_bfloat16', False)
+  matmul_precision = 'bfloat16' if use_bfloat16 else None
 
   @partial(jax.pmap, axis_name='batch')
   def compute_batch_outputs(params, images):
-    logits, out = model.apply({'params': flax.core.freeze(params)},
-                              images,
-                              train=False)
+    with jax.default_matmul_precision(matmul_precision):
+      logits, out = model.apply({'params': params}, images, train=False)
     if config and config.model_type == 'batchensemble':
       ens_size = config.model.transformer.ens_size
       loss_name = config.get('loss', 'sigmoid_xent')
-      logits = jnp.asarray(jnp.split(logits, ens_size))
+      # The members' outputs are tiled along the batch dimension, so a reshape
+      # exposes the ensemble axis without copying (unlike split and stack).
+      logits = logits.reshape((ens_size, -1) + logits.shape[1:])
       if loss_name == 'sigmoid_xent':
         if average_logits:
           logits = batchensemble_utils.log_average_sigmoid_probs(logits)
@@ -122,89 +144,139 @@ def get_ids_logits_masks(*,
 
     if use_pre_logits:
       # pre_logits [batch_size, hidden_size, ens_size]
+      pre_logits = out['pre_logits']
       pre_logits = jnp.transpose(
-          jnp.asarray(jnp.split(out['pre_logits'], ens_size)), axes=[1, 2, 0])
+          pre_logits.reshape((ens_size, -1) + pre_logits.shape[1:]),
+          axes=[1, 2, 0])
       output = pre_logits
     else:
       output = logits
 
     # TODO(joost,andreas): For multi host this requires:
     # output = jax.lax.all_gather(output, axis_name='batch')
-    return output
+    if score_fn is not None:
+      return score_fn(output.astype(jnp.float32))
+    if use_bfloat16 and use_pre_logits:
+      # The pre logits are much larger than the logits, and the density scores
+      # are robust to their rounding, so they are copied to and stored on host
+      # in half the bytes.
+      return output.astype(jnp.bfloat16)
+    return output.astype(jnp.float32)
+
+  return compute_batch_outputs
+
+
+@jax.pmap
+def _params_to_bfloat16(params):
+  return jax.tree_map(lambda x: x.astype(jnp.bfloat16), params)
 
-  iter_ds = input_utils.start_input_pipeline(ds, prefetch_to_device)
+
+def get_ids_logits_masks(*,
+                         inference_fn,
+                         opt_repl,
+                         ds,
+                         prefetch_to_device=1,
+                         config=None):
+  """Obtain (pre) logits, or scores computed from them, for each datapoint.
+
+  This can be then used to compute entropies, and so on.
+
+  Args:
+    inference_fn: the forward pass, see `create_pool_inference_fn`.
+    opt_repl: an optimizer with parameters.
+    ds: a dataset or an epoch function, see `start_epoch`.
+    prefetch_to_device: how many batches to prefix
+    config: experiment config. If `config.pool_inference_bfloat16` is set, the
+      parameters are stored in bfloat16.
+
+  Returns:
+    a tuple of np arrays of ids, logits (or scores) and masks.
+  """
+  params = opt_repl.target
+  if config and config.get('pool_inference_bfloat16', False):
+    # Halves the memory traffic for reading the weights. This path does not
+    # compute gradients, so the loss of precision does not accumulate.
+    params = _params_to_bfloat16(params)
+
+  iter_ds = start_epoch(ds, prefetch_to_device)
 
   outputs = []
   ids = []
-  labels = []
   masks = []
-  for _, batch in enumerate(iter_ds):
-    batch_id = batch['id']
-    batch_label = batch['labels']
-    batch_mask = batch['mask']
-    batch_output = compute_batch_outputs(opt_repl.target, batch['image'])
 
-    # TODO(joost,andreas): if we run on multi host, we need to index
-    # batch_outputs: batch_outputs[0]
+  def append_to_host(batch_results):
+    batch_id, batch_output, batch_mask = jax.device_get(batch_results)
     ids.append(batch_id)
     outputs.append(batch_output)
-    labels.append(batch_label)
     masks.append(batch_mask)
 
-  if average_logits:
-    # 0 dimension is TPU shard, 1 is batch
-    outputs = jnp.concatenate(outputs, axis=1)
-  else:
-    # 0 dimension is TPU shard, 1 is ensemble, 2 is batch
-    outputs = jnp.concatenate(outputs, axis=2)
+  # NOTE: the pool set is streamed from tf.data, as its images do not fit on the
+  # devices, so this loop cannot be a `lax.scan`. Instead, the scores are
+  # computed as part of the (pmapped) forward pass of each batch.
+  # The previous batch is copied to host after the current batch has been
+  # dispatched, such that the transfer overlaps with the computation.
+  pending_results = None
+  for batch in iter_ds:
+    batch_output = inference_fn(params, batch['image'])
 
-  ids = jnp.concatenate(ids, axis=1)
-  labels = jnp.concatenate(labels, axis=1)
-  masks = jnp.concatenate(masks, axis=1)
+    # TODO(joost,andreas): if we run on multi host, we need to index
+    # batch_outputs: batch_outputs[0]
+    if pending_results is not None:
+      append_to_host(pending_results)
+    pending_results = (batch['id'], batch_output, batch['mask'])
+
+  if pending_results is not None:
+    append_to_host(pending_results)
+
+  # 0 dimension is TPU shard, 1 is batch
+  outputs = np.concatenate(outputs, axis=1)
+  ids = np.concatenate(ids, axis=1)
+  masks = np.concatenate(masks, axis=1)
   # NOTE(joost,andreas): due to batch padding, entropies/ids will be of size:
   # if training set size % batch size > 0:
   # (training set size // batch size + 1) * batch size
   # else:
   # just training set size
 
-  return ids, outputs, labels, masks
+  return ids, outputs, masks
+
 
+# The score functions below are passed as `score_fn` to get_ids_logits_masks,
+# which applies them on each device to the logits of a batch of the pool set.
 
-def get_entropy_scores(logits, masks):
+
+def get_entropy_scores(logits):
   """Obtain scores using entropy scoring.
 
   Args:
     logits: the logits of the pool set.
-    masks: the masks belonging to the pool set.
 
   Returns:
     a list of scores belonging to the pool set.
   """
-  log_probs = jax.nn.log_softmax(logits)
-  probs = jax.nn.softmax(logits)
-
-  weighted_nats = -probs * log_probs
-  # One simple trick to avoid NaNs later on.
-  weighted_nats = jnp.where(jnp.isnan(weighted_nats), 0, weighted_nats)
-  entropy = jnp.sum(weighted_nats, axis=-1, keepdims=False)
-  entropy = jnp.where(masks, entropy, NINF_SCORE)
+  # H = log Z - sum_c p_c * logits_c, computed from a single shifted exp.
+  max_logits = jnp.max(logits, axis=-1, keepdims=True)
+  exp_logits = jnp.exp(logits - max_logits)
+  normalizer = jnp.sum(exp_logits, axis=-1, keepdims=True)
+  probs = exp_logits / normalizer
+  log_normalizer = jnp.squeeze(jnp.log(normalizer) + max_logits, axis=-1)
+  entropy = log_normalizer - jnp.sum(probs * logits, axis=-1)
 
   return entropy
 
 
-def get_bald_scores(logits, masks):
+def get_bald_scores(logits):
   """Obtain scores using BALD scoring.
 
   Args:
     logits: the logits of the pool set, first dimension is the ensemble.
-    masks: the masks belonging to the pool set.
 
   Returns:
     a list of scores belonging to the pool set.
   """
 
-  # TPU shard, ensemble size, batch size, logits
-  _, ens_size, _, _ = logits.shape
+  # ensemble size, batch size, logits
+  ens_size, _, _ = logits.shape
 
   log_probs = jax.nn.log_softmax(logits)
   probs = jax.nn.softmax(logits)
@@ -212,10 +284,10 @@ def get_bald_scores(logits, masks):
   weighted_nats = -probs * log_probs
   weighted_nats = jnp.where(jnp.isnan(weighted_nats), 0, weighted_nats)
 
-  marginal_entropy = jnp.mean(jnp.sum(weighted_nats, axis=-1), axis=1)
+  marginal_entropy = jnp.mean(jnp.sum(weighted_nats, axis=-1), axis=0)
 
-  marginal_log_probs = jax.nn.logsumexp(log_probs, axis=1) - jnp.log(ens_size)
-  marginal_probs = jnp.mean(probs, axis=1)
+  marginal_log_probs = jax.nn.logsumexp(log_probs, axis=0) - jnp.log(ens_size)
+  marginal_probs = jnp.mean(probs, axis=0)
 
   weighted_marginal_nats = -marginal_probs * marginal_log_probs
   weighted_marginal_nats = jnp.where(
@@ -223,42 +295,40 @@ def get_bald_scores(logits, masks):
 
   entropy_marginal = jnp.sum(weighted_marginal_nats, axis=-1)
 
-  # Mask results.
   bald = entropy_marginal - marginal_entropy
-  bald = jnp.where(masks, bald, NINF_SCORE)
 
   return bald
 
 
-def get_margin_scores(logits, masks):
+def get_margin_scores(logits):
   """Obtain scores using margin scoring.
 
   Args:
     logits: the logits of the pool set.
-    masks: the masks belonging to the pool set.
 
   Returns:
     a list of scores belonging to the pool set.
   """
-  probs = jax.nn.softmax(logits)
-  top2_probs = jax.lax.top_k(probs, k=2)[0]
+  # softmax is monotone, so the top-2 logits give the top-2 probabilities and
+  # only those two need to be normalized.
+  top2_logits = jax.lax.top_k(logits, k=2)[0]
+  log_normalizer = jax.nn.logsumexp(logits, axis=-1, keepdims=True)
+  top2_probs = jnp.exp(top2_logits - log_normalizer)
   # top_k's documentation does not specify whether the top-k are sorted or not.
   margins = jnp.abs(top2_probs[..., 0] - top2_probs[..., 1])
 
   # Lower margin means higher uncertainty, so we invert the scores.
   # Then higer margin score means higher uncertainty.
   margin_scores = -margins
-  margin_scores = jnp.where(masks, margin_scores, NINF_SCORE)
 
   return margin_scores
 
 
-def get_msp_scores(logits, masks):
+def get_msp_scores(logits):
   """Obtain scores using maximum softmax probability scoring.
 
   Args:
     logits: the logits of the pool set.
-    masks: the masks belonging to the pool set.
 
   Returns:
     a list of scores belonging to the pool set.
@@ -268,55 +338,100 @@ def get_msp_scores(logits, masks):
 
   # High max prob means low uncertainty, so we invert the value.
   msp_scores = -max_probs
-  msp_scores = jnp.where(masks, msp_scores, NINF_SCORE)
 
   return msp_scores
 
 
+# The acquisition methods whose scores are computed from the logits alone.
+SCORE_FNS = {
+    'entropy': get_entropy_scores,
+    'margin': get_margin_scores,
+    'msp': get_msp_scores,
+    'bald': get_bald_scores,
+}
+
+
+def create_acquisition_inference_fn(model, acquisition_method, config):
+  """Creates the pool forward pass specialized to an acquisition method."""
+  return create_pool_inference_fn(
+      model=model,
+      use_pre_logits=acquisition_method == 'density',
+      average_logits=acquisition_method != 'bald',
+      score_fn=SCORE_FNS.get(acquisition_method),
+      config=config)
+
+
 def get_uniform_scores(masks, rng):
   """Obtain scores using uniform sampling.
 
   Args:
-    masks: the masks belonging to the pool set.
+    masks: the masks belonging to the pool set (only used for the shape).
     rng: the RNG to use for uniform sampling.
 
   Returns:
     a list of scores belonging to the pool set.
   """
   uniform_scores = jax.random.uniform(key=rng, shape=masks.shape)
-  uniform_scores = jnp.where(masks, uniform_scores, NINF_SCORE)
 
   return uniform_scores
 
 
+@jax.jit
+def get_lda_log_likelihoods(embeds, means, cov_inv):
+  """Obtain the (unnormalized) log likelihoods under a fitted LDA model.
+
+  The Mahalanobis distances follow ood_utils.compute_mahalanobis_distance, but
+  are computed on device in float32.
+
+  Args:
+    embeds: the embeddings to evaluate, of shape [n_sample, n_dim].
+    means: the class means, of shape [n_class, n_dim].
+    cov_inv: the inverse of the shared covariance, of shape [n_dim, n_dim].
+
+  Returns:
+    the log likelihoods of the embeddings, of shape [n_sample].
+  """
+  # Center on the class means, such that the expanded terms below stay small
+  # and cancel less.
+  center = jnp.mean(means, axis=0)
+  embeds = embeds.astype(jnp.float32) - center
+  means = means - center
+  # Expand (x - m)^T vi (x - m) = x^T vi x + m^T vi m - 2 x^T vi m, such that
+  # the distances to all classes are computed with matrix products. The default
+  # precision would run these as bfloat16 passes on TPU.
+  dot = partial(jnp.dot, precision=jax.lax.Precision.HIGHEST)
+  embeds_vi = dot(embeds, cov_inv)
+  means_vi = dot(means, cov_inv)
+  dists = (jnp.sum(embeds_vi * embeds, axis=-1)[:, None] +
+           jnp.sum(means_vi * means, axis=-1)[None, :] -
+           2 * dot(embeds_vi, means.T))
+  # Rounding can still produce tiny negative values.
+  dists = jnp.maximum(dists, 0)
+
+  return jax.nn.logsumexp(-dists / 2, axis=-1)
+
+
 def get_density_scores(*,
-                       model,
-                       opt_repl,
-                       train_ds,
+                       train_pre_logits,
+                       train_labels,
+                       train_masks,
                        pool_pre_logits,
                        pool_masks,
-                       config=None):
+                       batch_size=8192):
   """Obtain scores using density method.
 
   Args:
-    model: an initialized model.
-    opt_repl: the current optimizer.
-    train_ds: the dataset to fit the density estimator on.
+    train_pre_logits: the pre logits (features) to fit the density estimator on.
+    train_labels: the labels belonging to the train_pre_logits.
+    train_masks: the masks belonging to the train_pre_logits.
     pool_pre_logits: the pre logits (features) of the pool set.
     pool_masks: the masks belonging to the pool_pre_logits.
-    config: experiment config.
+    batch_size: the number of pool points to evaluate on device at once.
 
   Returns:
     a list of scores belonging to the pool set.
   """
   # Fit LDA
-  _, train_pre_logits, train_labels, train_masks = get_ids_logits_masks(
-      model=model,
-      opt_repl=opt_repl,
-      ds=train_ds,
-      use_pre_logits=True,
-      config=config)
-
   train_masks_bool = train_masks.astype(bool)
   train_pre_logits = train_pre_logits[train_masks_bool].reshape(
       -1, train_pre_logits.shape[-1])
@@ -327,131 +442,218 @@ def get_density_scores(*,
 
   # Evaluate LDA on pool set
   pool_pre_logits = pool_pre_logits.reshape(-1, pool_pre_logits.shape[-1])
-  dists = ood_utils.compute_mahalanobis_distance(pool_pre_logits, mean_list,
-                                                 cov)
-  scores = np.array(jax.nn.logsumexp(-dists / 2, axis=-1))
+  # The (small) covariance matrix is inverted on host in double precision.
+  cov_inv = np.linalg.inv(cov + np.eye(cov.shape[0]) * 1e-20)
+  cov_inv = cov_inv.astype(np.float32)
+  means = np.array(mean_list, dtype=np.float32)
+  # The pool set is processed in batches of a fixed size, such that the device
+  # memory does not grow with the pool set, and all batches (including the
+  # padded last one) share one compilation.
+  scores = []
+  for start in range(0, pool_pre_logits.shape[0], batch_size):
+    batch = pool_pre_logits[start:start + batch_size]
+    num_valid = batch.shape[0]
+    batch = np.pad(batch, [(0, batch_size - num_valid), (0, 0)])
+    batch_scores = get_lda_log_likelihoods(batch, means, cov_inv)
+    scores.append(np.asarray(batch_scores)[:num_valid])
+  scores = np.concatenate(scores)
 
   # Convert likelihood to AL score
   pool_masks_bool = np.array(pool_masks.ravel(), dtype=bool)
-  scores[pool_masks_bool] = (
-      scores[pool_masks_bool].max() - scores[pool_masks_bool])
-  scores[~pool_masks_bool] = NINF_SCORE
+  scores = scores[pool_masks_bool].max() - scores
 
   return scores
 
 
+@partial(jax.jit, static_argnums=2)
+def _top_k_kept_scores(scores, keep, k):
+  """Returns the top k kept scores, their indices and the min/mean/max."""
+  scores = jnp.ravel(scores)
+  top_scores, top_scorers = jax.lax.top_k(jnp.where(keep, scores, -jnp.inf), k)
+  score_stats = (jnp.min(jnp.where(keep, scores, jnp.inf)),
+                 jnp.sum(jnp.where(keep, scores, 0)) / jnp.sum(keep),
+                 jnp.max(jnp.where(keep, scores, -jnp.inf)))
+  return top_scores, top_scorers, score_stats
+
+
 def select_acquisition_batch_indices(*, acquisition_batch_size, scores, ids,
-                                     ignored_ids):
+                                     masks, acquired_mask):
   """Select what data points to acquire from the pool set.
 
   Args:
     acquisition_batch_size: the number of data point to acquire.
     scores: acquisition scores assigned to data points.
     ids: the ids belonging to the scores.
-    ignored_ids: the ids to ignore (previously acquired).
+    masks: the masks belonging to the scores (zero for padding).
+    acquired_mask: a boolean array indexed by id, which is True for the ids to
+      ignore (previously acquired).
 
   Returns:
     a tuple of lists with the ids to be acquired and their scores.
   """
-  scores = np.array(scores.ravel())
+  # Only keep the actual pool set entries, not the batch padding.
+  keep = np.array(masks.ravel(), dtype=bool)
   ids = np.array(ids.ravel())
 
   # Ignore already acquired ids
-  # TODO(joost,andreas): vectorize this
-  ids_list = ids.tolist()
-  for ignored_id in ignored_ids:
-    scores[ids_list.index(ignored_id)] = NINF_SCORE
+  keep[keep] = ~acquired_mask[ids[keep]]
 
-  f_ent = scores[scores > NINF_SCORE]
-  logging.info(msg=f'Score statistics pool set - '
-               f'min: {f_ent.min()}, mean: {f_ent.mean()}, max: {f_ent.max()}')
+  # The selection happens on device, such that only the selected scores (and
+  # not the scores of the whole pool set) are copied to host. The scores that
+  # are not kept are masked rather than dropped, such that the shapes (and so
+  # the compiled computations) are the same in every round.
+  top_scores, top_scorers, (score_min, score_mean, score_max) = jax.device_get(
+      _top_k_kept_scores(scores, keep, acquisition_batch_size))
 
-  partitioned_scorers = np.argpartition(-scores, acquisition_batch_size)
-  top_scorers = partitioned_scorers[:acquisition_batch_size]
+  logging.info(msg=f'Score statistics pool set - '
+               f'min: {score_min}, mean: {score_mean}, max: {score_max}')
 
   top_ids = ids[top_scorers].tolist()
-  top_scores = scores[top_scorers].tolist()
+  top_scores = top_scores.tolist()
 
   logging.info(msg=f'Data selected - ids: {top_ids}, with scores: {top_scores}')
 
   return top_ids, top_scores
 
 
-def acquire_points(model, current_opt_repl, pool_train_ds, train_eval_ds,
-                   train_subset_data_builder, acquisition_method, config,
-                   rng_loop):
-  """Acquire ids of the current batch."""
-  pool_ids, pool_outputs, _, pool_masks = get_ids_logits_masks(
-      model=model,
-      opt_repl=current_opt_repl,
-      ds=pool_train_ds,
-      use_pre_logits=acquisition_method == 'density',
-      average_logits=acquisition_method != 'bald',
-      config=config)
+def get_ids_masks(ds):
+  """Obtain the ids and masks of a dataset, without running a model.
+
+  Args:
+    ds: a dataset with (at least) 'id' and 'mask' in its batches.
+
+  Returns:
+    a tuple of np arrays of ids and masks, laid out like the ones returned by
+    `get_ids_logits_masks` for a dataset that is batched in the same way, and
+    the number of batches read.
+  """
+  ids = []
+  masks = []
+  for batch in ds.as_numpy_iterator():
+    ids.append(batch['id'])
+    masks.append(batch['mask'])
+
+  # 0 dimension is TPU shard, 1 is batch
+  return np.concatenate(ids, axis=1), np.concatenate(masks, axis=1), len(ids)
+
+
+def acquire_points(inference_fn, current_opt_repl, pool_train_ds, pool_ids,
+                   pool_masks, train_metric_args, acquired_mask,
+                   acquisition_method, config, rng_loop):
+  """Acquire ids of the current batch.
+
+  `inference_fn` is the pool forward pass for `acquisition_method`, as created
+  by `create_acquisition_inference_fn`.
+
+  `pool_ids` and `pool_masks` are the ids and masks of `pool_train_ds`, as
+  returned by `get_ids_masks`. They are used as is when the scores do not
+  depend on the model, which saves a pass over the pool set.
+
+  `train_metric_args` are the (logits, labels, pre_logits, masks) of the
+  training set under `current_opt_repl`, as returned by `finetune`. They are
+  only needed for density scoring, and None if the training set is empty.
+  """
+  if acquisition_method == 'density' and train_metric_args is None:
+    # There is nothing to fit the density on, so we fall back to uniform.
+    acquisition_method = 'uniform'
 
   if acquisition_method == 'uniform':
     rng_loop, rng_acq = jax.random.split(rng_loop, 2)
     pool_scores = get_uniform_scores(pool_masks, rng_acq)
-  elif acquisition_method == 'entropy':
-    pool_scores = get_entropy_scores(pool_outputs, pool_masks)
-  elif acquisition_method == 'margin':
-    pool_scores = get_margin_scores(pool_outputs, pool_masks)
-  elif acquisition_method == 'msp':
-    pool_scores = get_msp_scores(pool_outputs, pool_masks)
-  elif acquisition_method == 'bald':
-    pool_scores = get_bald_scores(pool_outputs, pool_masks)
-  elif acquisition_method == 'density':
-    if train_subset_data_builder.subset_ids:
+  else:
+    pool_ids, pool_outputs, pool_masks = get_ids_logits_masks(
+        inference_fn=inference_fn,
+        opt_repl=current_opt_repl,
+        ds=pool_train_ds,
+        config=config)
+
+    if acquisition_method in SCORE_FNS:
+      # The scores were computed as part of the forward pass.
+      pool_scores = pool_outputs
+    elif acquisition_method == 'density':
+      _, train_labels, train_pre_logits, train_masks = train_metric_args
+      if config.model_type == 'batchensemble':
+        # evaluation_fn concatenates the members' pre logits, whereas the pool
+        # pre logits are of shape [..., hidden_size, ens_size].
+        ens_size = config.model.transformer.ens_size
+        train_pre_logits = train_pre_logits.reshape(
+            train_pre_logits.shape[:-1] + (ens_size, -1)).swapaxes(-1, -2)
       pool_scores = get_density_scores(
-          model=model,
-          opt_repl=current_opt_repl,
-          train_ds=train_eval_ds,
+          train_pre_logits=train_pre_logits,
+          train_labels=train_labels,
+          train_masks=train_masks,
           pool_pre_logits=pool_outputs,
-          pool_masks=pool_masks,
-          config=config)
+          pool_masks=pool_masks)
     else:
-      rng_loop, rng_acq = jax.random.split(rng_loop, 2)
-      pool_scores = get_uniform_scores(pool_masks, rng_acq)
-  else:
-    raise ValueError('Acquisition method not found.')
+      raise ValueError('Acquisition method not found.')
 
   acquisition_batch_ids, _ = select_acquisition_batch_indices(
       acquisition_batch_size=config.get('acquisition_batch_size', 10),
       scores=pool_scores,
       ids=pool_ids,
-      ignored_ids=train_subset_data_builder.subset_ids)
+      masks=pool_masks,
+      acquired_mask=acquired_mask)
 
   return acquisition_batch_ids, rng_loop
 
 
-def get_accuracy(*, evaluation_fn, opt_repl, ds, prefetch_to_device=1):
-  """A helper function to obtain accuracy over a dataset.
+def evaluate(*,
+             evaluation_fn,
+             opt_repl,
+             ds,
+             prefetch_to_device=1,
+             return_metric_args=False):
+  """Evaluates a model over a dataset, without waiting for the results.
 
   Args:
     evaluation_fn: a function that evaluates a forward pass in a model.
     opt_repl: an optimizer with parameters.
-    ds: a dataset.
+    ds: a dataset or an epoch function, see `start_epoch`.
     prefetch_to_device: number of batches to prefetc (default: 1).
+    return_metric_args: if True, also keep the metric_args of evaluation_fn
+      (logits, labels, pre logits and masks) for the whole dataset.
 
   Returns:
-    The accuracy as a float between 0 and 1.
+    A tuple of lists with the per-batch number of correct predictions, number
+    of seen examples and (if kept) metric_args, all as device arrays.
   """
-  iter_ds = input_utils.start_input_pipeline(ds, prefetch_to_device)
+  iter_ds = start_epoch(ds, prefetch_to_device)
 
-  ncorrect, nseen = [], []
+  ncorrect, nseen, metric_args = [], [], []
   for batch in iter_ds:
-    batch_ncorrect, _, batch_n, _ = evaluation_fn(opt_repl.target,
-                                                  batch['image'],
-                                                  batch['labels'],
-                                                  batch['mask'])
+    batch_ncorrect, _, batch_n, batch_metric_args = evaluation_fn(
+        opt_repl.target, batch['image'], batch['labels'], batch['mask'])
 
+    # Keep the counts on device, such that there is no host sync per batch.
     ncorrect += [batch_ncorrect[0]]
     nseen += [batch_n[0]]
+    if return_metric_args:
+      # metric_args are gathered across devices, so every device holds all.
+      metric_args += [[arg[0] for arg in batch_metric_args]]
+
+  return ncorrect, nseen, metric_args
+
 
-  ncorrect = np.sum(ncorrect)
-  nseen = np.sum(nseen)
+def get_accuracy(*, evaluation_fn, opt_repl, ds, prefetch_to_device=1):
+  """A helper function to obtain accuracy over a dataset.
+
+  Args:
+    evaluation_fn: a function that evaluates a forward pass in a model.
+    opt_repl: an optimizer with parameters.
+    ds: a dataset or an epoch function, see `start_epoch`.
+    prefetch_to_device: number of batches to prefetc (default: 1).
+
+  Returns:
+    The accuracy as a float between 0 and 1.
+  """
+  ncorrect, nseen, _ = evaluate(
+      evaluation_fn=evaluation_fn,
+      opt_repl=opt_repl,
+      ds=ds,
+      prefetch_to_device=prefetch_to_device)
+  ncorrect, nseen = jax.device_get((ncorrect, nseen))
 
-  return ncorrect / nseen
+  return np.sum(ncorrect) / np.sum(nseen)
 
 
 def finetune(*,
@@ -464,7 +666,9 @@ def finetune(*,
              train_eval_ds,
              val_ds,
              evaluation_fn,
+             accuracy_fn,
              early_stopping_patience,
+             keep_train_metric_args=False,
              prefetch_to_device=1,
              profiler=None):
   """Finetunes a model on a dataset.
@@ -477,43 +681,71 @@ def finetune(*,
     rngs_loop: the rng for the loop.
     total_steps: the total number of fine-tuning steps to take.
     train_eval_ds: train dataset in eval mode (no augmentation or shuffling).
-    val_ds: validation dataset for early stopping.
-    evaluation_fn: function used for evaluation on validation set.
+    val_ds: validation dataset (or epoch function) for early stopping.
+    evaluation_fn: function used for evaluation on the training set if
+      `keep_train_metric_args` is True.
+    accuracy_fn: function used for evaluation on validation set (and on the
+      training set otherwise), which does not need to return metric_args.
     early_stopping_patience: number of steps to wait before stopping training.
+    keep_train_metric_args: if True, keep the metric_args of `train_eval_ds`
+      under the returned optimizer, e.g. for density scoring.
     prefetch_to_device: number of batches to prefetc (default: 1).
     profiler: periodic_actions.Profile.
 
   Returns:
-    The optimizer with updated parameters and the updated rng.
+    The optimizer with updated parameters (on host, not replicated), the
+    updated rng and an info dict. The info dict contains the metric_args of
+    `train_eval_ds` under the returned optimizer as `best_train_metric_args`
+    (None unless `keep_train_metric_args` is True).
   """
   iter_ds = input_utils.start_input_pipeline(ds, prefetch_to_device)
-  lr_iter = train_utils.prefetch_scalar(
-      map(lr_fn, range(total_steps)), prefetch_to_device)
+
+  # Every distinct learning rate is replicated only once, rather than sending a
+  # scalar to the devices at every step (lr_fn is typically constant).
+  lr_repl_cache = {}
+
+  def get_lr_repl(step):
+    lr = lr_fn(step)
+    if lr not in lr_repl_cache:
+      lr_repl_cache[lr] = flax_utils.replicate(np.float32(lr))
+    return lr_repl_cache[lr]
 
   best_opt_accuracy = -1
   best_step = 1
 
-  train_val_accuracies = []
+  train_val_counts = []
 
-  for current_step, train_batch, lr_repl in zip(
-      tqdm.trange(1, total_steps + 1), iter_ds, lr_iter):
+  for current_step, train_batch in zip(
+      tqdm.trange(1, total_steps + 1), iter_ds):
+    lr_repl = get_lr_repl(current_step - 1)
+    # update_fn splits the (donated) rngs on device and returns the next ones,
+    # so there is no host-side key splitting or transfer per step.
     opt_repl, rngs_loop, _ = update_fn(opt_repl, lr_repl, train_batch['image'],
                                        train_batch['labels'], rngs_loop)
     if jax.process_index() == 0 and profiler is not None:
       profiler(current_step)
     if current_step % 5 == 0:
-      train_accuracy = get_accuracy(
-          evaluation_fn=evaluation_fn, opt_repl=opt_repl, ds=train_eval_ds)
+      # Only the validation accuracy is needed for early stopping. The training
+      # set results stay on device and are copied to host after the loop.
+      train_ncorrect, train_nseen, train_metric_args = evaluate(
+          evaluation_fn=(evaluation_fn if keep_train_metric_args
+                         else accuracy_fn),
+          opt_repl=opt_repl,
+          ds=train_eval_ds,
+          prefetch_to_device=prefetch_to_device,
+          return_metric_args=keep_train_metric_args)
       val_accuracy = get_accuracy(
-          evaluation_fn=evaluation_fn, opt_repl=opt_repl, ds=val_ds)
-      logging.info(
-          msg=f'Current accuracy - train:{train_accuracy}, val: {val_accuracy}')
-      train_val_accuracies.append((current_step, train_accuracy, val_accuracy))
+          evaluation_fn=accuracy_fn, opt_repl=opt_repl, ds=val_ds)
+      logging.info(msg=f'Current accuracy - val: {val_accuracy}')
+      train_val_counts.append(
+          (current_step, train_ncorrect, train_nseen, val_accuracy))
 
       if val_accuracy >= best_opt_accuracy:
         best_step = current_step
         best_opt_accuracy = val_accuracy
-        best_opt_repl = jax.device_get(opt_repl)
+        # The replicas are identical, so only one of them is copied to host.
+        best_opt_cpu = jax.device_get(flax_utils.unreplicate(opt_repl))
+        best_train_metric_args = train_metric_args
       else:
         logging.info(
             msg=(f'Current val accuracy {val_accuracy} '
@@ -522,19 +754,42 @@ def finetune(*,
           logging.info(msg='Early stopping, returning best opt_repl!')
           break
 
-  # best_opt_repl could be unassigned, but we should error out then
+  # best_opt_cpu could be unassigned, but we should error out then
+
+  # Copy the training set counts of all evaluations to host at once.
+  train_counts = jax.device_get(
+      [(ncorrect, nseen) for _, ncorrect, nseen, _ in train_val_counts])
+  train_val_accuracies = []
+  for (step, _, _, val_accuracy), (ncorrect, nseen) in zip(
+      train_val_counts, train_counts):
+    train_accuracy = np.sum(ncorrect) / np.sum(nseen)
+    logging.info(msg=(f'Accuracy at step {step} - train: {train_accuracy}, '
+                      f'val: {val_accuracy}'))
+    train_val_accuracies.append((step, train_accuracy, val_accuracy))
+
+  if keep_train_metric_args:
+    # 0 dimension is TPU shard, 1 is batch
+    best_train_metric_args = [
+        np.concatenate(arg, axis=1)
+        for arg in zip(*jax.device_get(best_train_metric_args))
+    ]
+  else:
+    best_train_metric_args = None
 
   info = dict(
       best_val_accuracy=best_opt_accuracy,
       best_step=best_step,
+      best_train_metric_args=best_train_metric_args,
       train_val_accuracies=train_val_accuracies)
 
-  return best_opt_repl, rngs_loop, info
+  return best_opt_cpu, rngs_loop, info
 
 
 def main(config, output_dir):
   if jax.process_count() > 1:
-    raise NotImplementedError
+    raise NotImplementedError(
+        'Active learning only supports a single host, as pool inference and '
+        'the acquisition do not gather their outputs across hosts.')
   # Note: switch to ProfileAllHosts() if you need to profile all hosts.
   # (Xprof data become much larger and take longer to load for analysis)
   profiler = periodic_actions.Profile(
@@ -545,6 +800,13 @@ def main(config, output_dir):
 
   logging.info(config)
 
+  # Every acquisition round compiles the same functions for the same shapes.
+  # A persistent compilation cache lets restarts (and repeated runs, e.g. in a
+  # sweep) load them from disk instead of compiling them again.
+  compilation_cache_dir = config.get('compilation_cache_dir')
+  if compilation_cache_dir:
+    compilation_cache.initialize_cache(compilation_cache_dir)
+
   acquisition_method = config.get('acquisition_method')
   if acquisition_method == 'bald':
     assert config.model_type == 'batchensemble', 'Bald requires batch ensemble'
@@ -572,9 +834,27 @@ def main(config, output_dir):
 
   batch_size = config.batch_size
   batch_size_eval = config.get('batch_size_eval', batch_size)
+  if (batch_size % jax.device_count() != 0 or
+      batch_size_eval % jax.device_count() != 0):
+    raise ValueError(f'Batch sizes ({batch_size} and {batch_size_eval}) must '
+                     f'be divisible by device number ({jax.device_count()})')
 
   local_batch_size = batch_size // jax.process_count()
   local_batch_size_eval = batch_size_eval // jax.process_count()
+  logging.info(
+      'Global batch size %d on %d hosts results in %d local batch size. '
+      'With %d devices per host (%d devices total), that\'s a %d per-device '
+      'batch size.', batch_size, jax.process_count(), local_batch_size,
+      jax.local_device_count(), jax.device_count(),
+      local_batch_size // jax.local_device_count())
+
+  # The validation, test and pool sets are iterated at least once per
+  # acquisition round, so we cache the validation and test sets. Caching happens
+  # before decoding and preprocessing, which keeps the memory footprint to that
+  # of the encoded dataset. The pool set is only cached with `config.cache_pool`
+  # as it can be much larger than host memory. All three are repeated forever,
+  # such that the same iterator can be used for all passes over them (see
+  # `start_epoch_input_pipeline` below).
 
   val_ds = input_utils.get_data(
       dataset=config.dataset,
@@ -584,8 +864,10 @@ def main(config, output_dir):
       preprocess_fn=preprocess_spec.parse(
           spec=config.pp_eval, available_ops=preprocess_utils.all_ops()),
       shuffle=False,
+      cache='loaded',
       prefetch_size=config.get('prefetch_to_host', 2),
-      num_epochs=1,  # Only repeat once.
+      num_epochs=None,
+      repeat_after_batching=True,
   )
 
   test_ds = input_utils.get_data(
@@ -596,8 +878,10 @@ def main(config, output_dir):
       preprocess_fn=preprocess_spec.parse(
           spec=config.pp_eval, available_ops=preprocess_utils.all_ops()),
       shuffle=False,
+      cache='loaded',
       prefetch_size=config.get('prefetch_to_host', 2),
-      num_epochs=1,  # Only repeat once.
+      num_epochs=None,
+      repeat_after_batching=True,
   )
 
   # Init model
@@ -654,6 +938,19 @@ def main(config, output_dir):
 
   update_fn = model_utils.create_update_fn(model, config)
   evaluation_fn = model_utils.create_evaluation_fn(model, config)
+  # The validation and test sets are evaluated only for their accuracy, so
+  # their logits, labels and pre logits need not be gathered across devices.
+  accuracy_fn = model_utils.create_evaluation_fn(
+      model, config, gather_metric_args=False)
+  # Created once, such that it is compiled only once rather than every round.
+  inference_fn = create_acquisition_inference_fn(model, acquisition_method,
+                                                 config)
+
+  # The pretrained optimizer is broadcast to the devices only once. As
+  # update_fn donates its optimizer argument, each round fine-tunes a copy made
+  # on the devices themselves.
+  opt_repl = flax_utils.replicate(opt_cpu)
+  copy_to_devices = jax.pmap(lambda tree: jax.tree_map(jnp.copy, tree))
 
   # NOTE: We need this because we need an Id field of type int.
   # TODO(andreas): Rename to IdSubsetDatasetBuilder?
@@ -674,18 +971,77 @@ def main(config, output_dir):
           spec=config.pp_eval, available_ops=preprocess_utils.all_ops()),
       shuffle=False,
       drop_remainder=False,
+      cache='loaded' if config.get('cache_pool', False) else False,
       prefetch_size=config.get('prefetch_to_host', 2),
-      num_epochs=1,  # Don't repeat
+      num_epochs=None,
+      repeat_after_batching=True,
   )
 
+  # The ids and masks of the pool set do not depend on the model, so they are
+  # read once, without decoding any images. Uniform sampling needs nothing
+  # else, so it does not need to run the model on the pool set.
+  pool_ids_ds = input_utils.get_data(
+      dataset=pool_subset_data_builder,
+      split=config.train_split,
+      rng=pool_ds_rng,
+      process_batch_size=local_batch_size,
+      preprocess_fn=preprocess_spec.parse(
+          spec='keep(["id"])', available_ops=preprocess_utils.all_ops()),
+      shuffle=False,
+      drop_remainder=False,
+      num_epochs=1,
+  )
+  pool_ids, pool_masks, num_pool_batches_read = get_ids_masks(pool_ids_ds)
+
+  # Number of batches that are copied to the devices ahead of being used, for
+  # all datasets, such that the transfers overlap with the computation.
+  prefetch_to_device = config.get('prefetch_to_device', 1)
+
+  # Keep one iterator per dataset alive across acquisition rounds, rather than
+  # paying the start-up cost of the input pipeline for every pass.
+  val_ds = input_utils.start_epoch_input_pipeline(
+      val_ds,
+      input_utils.get_num_batches(
+          data_builder,
+          split=config.val_split,
+          process_batch_size=local_batch_size_eval,
+          drop_remainder=True),
+      n_prefetch=prefetch_to_device)
+  test_ds = input_utils.start_epoch_input_pipeline(
+      test_ds,
+      input_utils.get_num_batches(
+          data_builder,
+          split=config.test_split,
+          process_batch_size=local_batch_size_eval,
+          drop_remainder=True),
+      n_prefetch=prefetch_to_device)
+  num_pool_batches = input_utils.get_num_batches(
+      data_builder,
+      split=config.train_split,
+      process_batch_size=local_batch_size,
+      drop_remainder=False)
+  # Every pass over the (repeated) pool set takes `num_pool_batches` batches.
+  # If that count were off, later passes would silently start mid-epoch and
+  # misalign the pool ids, so it is checked against the actual pass above.
+  if num_pool_batches != num_pool_batches_read:
+    raise ValueError(
+        f'Expected {num_pool_batches} batches per epoch of the pool set, but '
+        f'read {num_pool_batches_read}.')
+  pool_train_ds = input_utils.start_epoch_input_pipeline(
+      pool_train_ds, num_pool_batches, n_prefetch=prefetch_to_device)
+
   # Potentially acquire an initial training set.
   initial_training_set_size = config.get('initial_training_set_size', 10)
 
-  if initial_training_set_size > 0:
-    current_opt_repl = flax_utils.replicate(opt_cpu)
-    pool_ids, _, _, pool_masks = get_ids_logits_masks(
-        model=model, opt_repl=current_opt_repl, ds=pool_train_ds, config=config)
+  # Marks the acquired ids. Only pool ids can be acquired, so the mask covers
+  # every id up to the largest one read from the pool set (the ids are not
+  # necessarily bounded by the split sizes, e.g. with mocked data). This
+  # fixed-size mask is the bookkeeping used for the acquisition, whereas
+  # `train_subset_data_builder.subset_ids` (a set, so adding to it and taking
+  # its length are constant time) is only used to build the training datasets.
+  acquired_mask = np.zeros(pool_ids.max() + 1, dtype=bool)
 
+  if initial_training_set_size > 0:
     rng, initial_uniform_rng = jax.random.split(rng)
     pool_scores = get_uniform_scores(pool_masks, initial_uniform_rng)
 
@@ -693,8 +1049,10 @@ def main(config, output_dir):
         acquisition_batch_size=initial_training_set_size,
         scores=pool_scores,
         ids=pool_ids,
-        ignored_ids=set(),
+        masks=pool_masks,
+        acquired_mask=acquired_mask,
     )
+    acquired_mask[initial_training_set_batch_ids] = True
   else:
     initial_training_set_batch_ids = []
 
@@ -718,6 +1076,13 @@ def main(config, output_dir):
   # NOTE: train_ds_rng is re-used for all train_ds creations
   rng, train_ds_rng = jax.random.split(rng)
 
+  # Checkpoint every `checkpoint_rounds` fine-tuning rounds, if set.
+  save_checkpoint_path = None
+  if config.get('checkpoint_rounds'):
+    save_checkpoint_path = os.path.join(output_dir, 'checkpoint.npz')
+  checkpoint_writer = None
+  finetuning_rounds = 0
+
   measurements = {}
   accumulated_steps = 0
   while True:
@@ -726,8 +1091,6 @@ def main(config, output_dir):
       break
     write_note(f'Training set size: {current_train_ds_length}')
 
-    current_opt_repl = flax_utils.replicate(opt_cpu)
-
     # Only fine-tune if there is anything to fine-tune with.
     if current_train_ds_length > 0:
       # Repeat dataset to have oversampled epochs and bootstrap more batches
@@ -739,6 +1102,10 @@ def main(config, output_dir):
       # of size batch_size, even at start of training. These batches will be
       # effectively 'bootstrap' sampled, meaning they are sampled with
       # replacement from the original training set.
+      # NOTE: as all batches (also the padded ones of train_eval_ds below) have
+      # the same shape, whatever the training set size, the compiled update and
+      # evaluation functions are reused across rounds and no bucketing of the
+      # training set size is needed.
       repeated_train_ds = input_utils.get_data(
           dataset=train_subset_data_builder,
           split=config.train_split,
@@ -777,9 +1144,9 @@ def main(config, output_dir):
       lr_fn = lambda x: config.lr.base
 
       early_stopping_patience = config.get('early_stopping_patience', 15)
-      current_opt_repl, rngs_loop, measurements = finetune(
+      best_opt_cpu, rngs_loop, measurements = finetune(
           update_fn=update_fn,
-          opt_repl=current_opt_repl,
+          opt_repl=copy_to_devices(opt_repl),
           lr_fn=lr_fn,
           ds=repeated_train_ds,
           rngs_loop=rngs_loop,
@@ -787,8 +1154,13 @@ def main(config, output_dir):
           train_eval_ds=train_eval_ds,
           val_ds=val_ds,
           evaluation_fn=evaluation_fn,
+          accuracy_fn=accuracy_fn,
           early_stopping_patience=early_stopping_patience,
+          keep_train_metric_args=acquisition_method == 'density',
+          prefetch_to_device=prefetch_to_device,
           profiler=profiler)
+      current_opt_repl = flax_utils.replicate(best_opt_cpu)
+      train_metric_args = measurements.pop('best_train_metric_args')
       train_val_accuracies = measurements.pop('train_val_accuracies')
       current_steps = 0
       for step, train_acc, val_acc in train_val_accuracies:
@@ -798,11 +1170,27 @@ def main(config, output_dir):
         })
         current_steps = step
       accumulated_steps += current_steps + 10
+      finetuning_rounds += 1
+
+      # Checkpoint the fine-tuned model (which is already on host) in the
+      # background, such that writing it overlaps with the rest of the round.
+      # Only the previous write is waited for, which will have long finished.
+      if (save_checkpoint_path and
+          finetuning_rounds % config.checkpoint_rounds == 0):
+        if checkpoint_writer is not None:
+          checkpoint_writer.get()
+        checkpoint_writer = pool.apply_async(
+            checkpoint_utils.save_checkpoint,
+            (dict(
+                opt=best_opt_cpu,
+                training_ids=np.flatnonzero(acquired_mask).astype(np.int32)),
+             save_checkpoint_path))
     else:
-      train_eval_ds = None
+      current_opt_repl = opt_repl
+      train_metric_args = None
 
     test_accuracy = get_accuracy(
-        evaluation_fn=evaluation_fn, opt_repl=current_opt_repl, ds=test_ds)
+        evaluation_fn=accuracy_fn, opt_repl=current_opt_repl, ds=test_ds)
 
     write_note(f'Accuracy at {current_train_ds_length}: {test_accuracy}')
 
@@ -810,9 +1198,14 @@ def main(config, output_dir):
     training_sizes.append(current_train_ds_length)
 
     acquisition_batch_ids, rng_loop = acquire_points(
-        model, current_opt_repl, pool_train_ds, train_eval_ds,
-        train_subset_data_builder, acquisition_method, config, rng_loop)
+        inference_fn, current_opt_repl, pool_train_ds, pool_ids, pool_masks,
+        train_metric_args, acquired_mask, acquisition_method, config, rng_loop)
+    # update_fn donates the optimizer being fine-tuned, but this round's
+    # fine-tuned optimizer would otherwise stay alive on the devices during the
+    # next round's fine-tuning.
+    del current_opt_repl
     train_subset_data_builder.subset_ids.update(acquisition_batch_ids)
+    acquired_mask[acquisition_batch_ids] = True
 
     measurements.update({'test_accuracy': test_accuracy})
     writer.write_scalars(current_train_ds_length, measurements)
@@ -821,10 +1214,12 @@ def main(config, output_dir):
              f'{train_subset_data_builder.subset_ids}'
              f'Accuracies: {test_accuracies}')
 
+  # Wait for the last checkpoint to be written (and raise if that failed).
+  if checkpoint_writer is not None:
+    checkpoint_writer.get()
   pool.close()
   pool.join()
   writer.close()
-  # TODO(joost,andreas): save the final checkpoint
   return (train_subset_data_builder.subset_ids, test_accuracies)
 
 
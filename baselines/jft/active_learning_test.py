@@ -16,6 +16,73 @@
 """Tests for the for the Active Learning with a pre-trained model script."""
 # TODO(joost,andreas): Refactor active_learning.py and use this test for smaller
 # components including acquisition functions and other utility functions.
+
+from absl.testing import absltest
+import jax
+import numpy as np
+import active_learning  # local file import from baselines.jft
+
+
+class AcquisitionTest(absltest.TestCase):
+
+  def test_select_acquisition_batch_indices(self):
+    # Scores, ids and masks are [num_devices, batch_size], as for the pool set.
+    # The last two entries are padding, with (high) scores that must be ignored.
+    scores = np.array([[0.1, 0.9, 0.5, 0.7, 10., 10.]], dtype=np.float32)
+    ids = np.array([[5, 3, 8, 1, 0, 0]])
+    masks = np.array([[1, 1, 1, 1, 0, 0]])
+    # Id 3 has the highest score, but was acquired already.
+    acquired_mask = np.zeros(9, dtype=bool)
+    acquired_mask[3] = True
+
+    top_ids, top_scores = active_learning.select_acquisition_batch_indices(
+        acquisition_batch_size=2,
+        scores=scores,
+        ids=ids,
+        masks=masks,
+        acquired_mask=acquired_mask)
+
+    # The ids are returned in order of decreasing score.
+    self.assertEqual(top_ids, [1, 8])
+    np.testing.assert_allclose(top_scores, [0.7, 0.5], rtol=1e-6)
+
+  def test_select_acquisition_batch_indices_never_selects_ignored(self):
+    scores = np.array([[3., 2., 1., 0.]], dtype=np.float32)
+    ids = np.array([[2, 1, 0, 0]])
+    masks = np.array([[1, 1, 1, 0]])
+    acquired_mask = np.array([False, False, True])
+
+    # Only ids 0 and 1 can be acquired, so asking for both returns them.
+    top_ids, _ = active_learning.select_acquisition_batch_indices(
+        acquisition_batch_size=2,
+        scores=scores,
+        ids=ids,
+        masks=masks,
+        acquired_mask=acquired_mask)
+
+    self.assertEqual(top_ids, [1, 0])
+
+  def test_get_entropy_scores(self):
+    logits = np.random.normal(size=(8, 10)).astype(np.float32)
+    # Include logits large enough to overflow an unshifted exp.
+    logits[0] *= 100
+
+    scores = active_learning.get_entropy_scores(logits)
+
+    expected = -np.sum(
+        jax.nn.softmax(logits) * jax.nn.log_softmax(logits), axis=-1)
+    np.testing.assert_allclose(scores, expected, rtol=1e-5, atol=1e-4)
+
+  def test_get_margin_scores(self):
+    logits = np.random.normal(size=(8, 10)).astype(np.float32)
+
+    scores = active_learning.get_margin_scores(logits)
+
+    sorted_probs = np.sort(jax.nn.softmax(logits), axis=-1)
+    expected = -(sorted_probs[:, -1] - sorted_probs[:, -2])
+    np.testing.assert_allclose(scores, expected, rtol=1e-5, atol=1e-6)
+
+
 # pylint: disable=pointless-string-statement
 """
 import os.path
@@ -101,3 +168,7 @@ class ActiveLearningTest(parameterized.TestCase, tf.test.TestCase):
 if __name__ == '__main__':
   tf.test.main()
 """
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -17,10 +17,11 @@
 import dataclasses
 import logging
 import re
-from typing import Dict, Iterable, List, Optional, Set, Union
+from typing import Callable, Dict, Iterable, List, Optional, Union
 
 from clu.deterministic_data import DatasetBuilder
 import jax
+import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 
@@ -52,33 +53,39 @@ class TFDSIdToInt:
 
     self.shard_offsets = shard_offsets
 
-  def __call__(self, tfds_id: str) -> int:
-    """Format the tfds_id in a more human-readable."""
-    match = self.tfds_id_parser_re.match(tfds_id)
-    split_name, shard_id, ex_id = match.groups()
-    shard_offsets = self.shard_offsets[split_name]
-    return shard_offsets[int(shard_id)] + int(ex_id)
+  def as_tf_fn(self) -> Callable[[tf.Tensor], tf.Tensor]:
+    """Return a TF function that formats tfds_id string tensors to ints.
 
-
-def _subset_generator(*, dataset: tf.data.Dataset,
-                      dataset_info: tfds.core.DatasetInfo,
-                      subset_ids: Optional[Set[int]], splitwise_id: bool):
-  """Create a subset based on ids."""
-  tfds_id_to_int = TFDSIdToInt(dataset_info, splitwise_id=splitwise_id)
-
-  def inner():
-    if subset_ids is not None:
-      # Hard fail on type errors
-      assert all(map(lambda id: isinstance(id, int), subset_ids))
-
-    for record in dataset:
-      tfds_id = record['tfds_id'].numpy().decode('utf-8')
-      int_id = tfds_id_to_int(tfds_id)
-      if subset_ids is None or int_id in subset_ids:
-        record['id'] = tf.constant(int_id)
-        yield record
-
-  return inner
+    This allows mapping ids inside a tf.data pipeline without calling back into
+    Python for every record. Ids of unknown splits or shards raise an error.
+    """
+    keys, offsets = [], []
+    for split_name, shard_offsets in self.shard_offsets.items():
+      for shard_id, shard_offset in enumerate(shard_offsets):
+        keys.append(f'{split_name}-{shard_id}')
+        offsets.append(shard_offset)
+    offset_table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(
+            tf.constant(keys, dtype=tf.string),
+            tf.constant(offsets, dtype=tf.int64)),
+        default_value=-1)
+    pattern = f'^{self.tfds_id_parser_re.pattern}$'
+
+    def tfds_id_to_int(tfds_id: tf.Tensor) -> tf.Tensor:
+      split_name = tf.strings.regex_replace(tfds_id, pattern, r'\1')
+      shard_id = tf.strings.to_number(
+          tf.strings.regex_replace(tfds_id, pattern, r'\2'), tf.int64)
+      ex_id = tf.strings.to_number(
+          tf.strings.regex_replace(tfds_id, pattern, r'\3'), tf.int64)
+      shard_offset = offset_table.lookup(
+          tf.strings.join([split_name, tf.strings.as_string(shard_id)], '-'))
+      with tf.control_dependencies([
+          tf.debugging.assert_non_negative(
+              shard_offset, message='Unknown split or shard in tfds_id.')
+      ]):
+        return shard_offset + ex_id
+
+    return tfds_id_to_int
 
 
 class SubsetDatasetBuilder(DatasetBuilder):
@@ -114,19 +121,33 @@ class SubsetDatasetBuilder(DatasetBuilder):
     dataset = self.base_dataset_builder.as_dataset(
         split=split, shuffle_files=False, read_config=read_config, **kwargs)
 
-    element_spec = dataset.element_spec.copy()
-    element_spec['id'] = tf.TensorSpec(shape=(), dtype=tf.int64, name=None)
-    logging.info(msg=f'element_spec = {element_spec}; '
-                 f'type = {jax.tree_map(type, element_spec)}')
-
-    dataset = tf.data.Dataset.from_generator(
-        _subset_generator(
-            dataset=dataset,
-            dataset_info=self.base_dataset_builder.info,
-            subset_ids=self.subset_ids,
-            splitwise_id=True),
-        output_signature=element_spec,
-    )
+    tfds_id_to_int = TFDSIdToInt(
+        self.base_dataset_builder.info, splitwise_id=True).as_tf_fn()
+
+    def add_id(record):
+      record['id'] = tfds_id_to_int(record['tfds_id'])
+      return record
+
+    dataset = dataset.map(add_id, num_parallel_calls=tf.data.AUTOTUNE)
+
+    if self.subset_ids is not None:
+      # Hard fail on type errors
+      assert all(map(lambda id: isinstance(id, int), self.subset_ids))
+
+      # A dense boolean mask over the ids turns the membership test into a
+      # single gather. It covers the ids up to the largest subset id, plus one
+      # trailing False entry that all larger ids are clipped to. The mask is
+      # built when the dataset is created, so later changes to `subset_ids`
+      # require calling `as_dataset` again.
+      num_ids = max(self.subset_ids, default=-1) + 1
+      subset_mask = np.zeros(num_ids + 1, dtype=bool)
+      subset_mask[list(self.subset_ids)] = True
+      subset_mask = tf.constant(subset_mask)
+      dataset = dataset.filter(lambda record: tf.gather(
+          subset_mask, tf.minimum(record['id'], num_ids)))
+
+    logging.info(msg=f'element_spec = {dataset.element_spec}; '
+                 f'type = {jax.tree_map(type, dataset.element_spec)}')
 
     # This is a bit more complex: potentially cache before or after calling
     # .shuffle. BUT don't cache for the pool set as it will be much larger than
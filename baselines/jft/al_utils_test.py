@@ -15,6 +15,8 @@
 
 """Tests for al_utils."""
 
+import types
+
 import tensorflow as tf
 import tensorflow_datasets as tfds
 # pylint: disable=unused-import # to register Cifar10Subset as dataset
@@ -23,6 +25,36 @@ import al_utils  # local file import from baselines.jft
 
 class AlUtilsTest(tf.test.TestCase):
 
+  def test_tfds_id_to_int(self):
+    # Only the shard lengths of the splits are used, so no download is needed.
+    dataset_info = types.SimpleNamespace(
+        splits={
+            'train': types.SimpleNamespace(shard_lengths=[3, 4, 2]),
+            'test': types.SimpleNamespace(shard_lengths=[5, 1]),
+        })
+    tfds_ids = [
+        'cifar10-train.tfrecord-00000-of-00003__0',
+        'cifar10-train.tfrecord-00000-of-00003__2',
+        'cifar10-train.tfrecord-00001-of-00003__3',
+        'cifar10-train.tfrecord-00002-of-00003__1',
+        'cifar10-test.tfrecord-00000-of-00002__4',
+        'cifar10-test.tfrecord-00001-of-00002__0',
+    ]
+
+    splitwise_fn = al_utils.TFDSIdToInt(
+        dataset_info, splitwise_id=True).as_tf_fn()
+    self.assertAllEqual(
+        splitwise_fn(tf.constant(tfds_ids)), [0, 2, 6, 8, 4, 5])
+
+    # Splits are offset in sorted order, so test comes before train.
+    global_fn = al_utils.TFDSIdToInt(
+        dataset_info, splitwise_id=False).as_tf_fn()
+    self.assertAllEqual(
+        global_fn(tf.constant(tfds_ids)), [6, 8, 12, 14, 4, 5])
+
+    with self.assertRaises(tf.errors.InvalidArgumentError):
+      splitwise_fn(tf.constant(['cifar10-train.tfrecord-00003-of-00004__0']))
+
   def test_mnist_subset_has_ids(self):
     # NOTE: MNIST has no id field, so this tests the enumerate code path.
     mnist_builder = tfds.builder('mnist')
@@ -268,7 +268,7 @@ def create_batch_loss_fn(model, config):
   """
 
   def batch_loss_fn(params, images, labels, rngs):
-    logits, _ = model.apply({'params': flax.core.freeze(params)},
+    logits, _ = model.apply({'params': params},
                             images,
                             train=True,
                             rngs=rngs)
@@ -293,7 +293,7 @@ def create_update_fn(model, config):
 
   batch_loss_fn = create_batch_loss_fn(model, config)
 
-  @functools.partial(jax.pmap, axis_name='batch', donate_argnums=(0, 1))
+  @functools.partial(jax.pmap, axis_name='batch', donate_argnums=(0, 4))
   def update_fn(opt, lr, images, labels, rngs):
     return update_fn_be(
         opt=opt,
@@ -314,12 +314,16 @@ def create_update_fn(model, config):
 
 # TODO(trandustin, zmariet): Unify all evaluation functions and other utility
 # functions used in different models.
-def create_evaluation_fn(model, config):
+def create_evaluation_fn(model, config, gather_metric_args=True):
   """Create the evaluation function from model and config.
 
   Args:
     model: The model to be used in updates.
     config: The config of the experiment.
+    gather_metric_args: Whether to gather and return the metric_args (logits,
+      labels, pre logits and masks). If False, None is returned in their place,
+      which saves gathering them across devices when only the accuracy or loss
+      is needed.
 
   Returns:
     The function that evaluates the model for one step.
@@ -328,7 +332,7 @@ def create_evaluation_fn(model, config):
   def evaluation_fn(params, images, labels, mask):
     # Ignore the entries with all zero labels for evaluation.
     mask *= labels.max(axis=1)
-    tiled_logits, out = model.apply({'params': flax.core.freeze(params)},
+    tiled_logits, out = model.apply({'params': params},
                                     images,
                                     train=False)
 
@@ -355,6 +359,9 @@ def create_evaluation_fn(model, config):
     ncorrect = jax.lax.psum(top1_correct * mask, axis_name='batch')
     n = jax.lax.psum(mask, axis_name='batch')
 
+    if not gather_metric_args:
+      return ncorrect, loss, n, None
+
     metric_args = jax.lax.all_gather(
         [ens_logits, labels, pre_logits, mask],
         axis_name='batch')
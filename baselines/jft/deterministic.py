@@ -360,7 +360,13 @@ def main(config, output_dir):
 
   @functools.partial(jax.pmap, axis_name='batch', donate_argnums=(0,))
   def update_fn(opt, lr, images, labels, rng):
-    """Update step. Copy to deterministic_utils.py whenever changes are made!"""
+    """Update step. Copy to deterministic_utils.py whenever changes are made!
+
+    Except for these deliberate differences in deterministic_utils.py, which is
+    used by the active learning loop: it computes the gradient norm only for
+    clipping and not the parameter norm (neither is logged there), it also
+    donates the rng, and it does not re-freeze the params.
+    """
     measurements = {}
 
     # Split rng and return next_rng for the following step.
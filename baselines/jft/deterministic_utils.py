@@ -91,6 +91,12 @@ def create_init(model, config, train_ds):
   return init
 
 
+def _tree_l2_norm(tree):
+  """Computes the global l2 norm over all leaves of a pytree."""
+  return jnp.sqrt(
+      jax.tree_util.tree_reduce(lambda acc, p: acc + jnp.vdot(p, p), tree, 0.))
+
+
 def create_update_fn(model, config):
   """Create the update function from model and config.
 
@@ -108,9 +114,9 @@ def create_update_fn(model, config):
   logging.info('weight_decay_rules = %s', weight_decay_rules)
   logging.info('rescale_value = %s', rescale_value)
 
-  @functools.partial(jax.pmap, axis_name='batch', donate_argnums=(0,))
+  @functools.partial(jax.pmap, axis_name='batch', donate_argnums=(0, 4))
   def update_fn(opt, lr, images, labels, rng):
-    """Update step."""
+    """Update step, mirroring deterministic.py (see the contract there)."""
 
     measurements = {}
 
@@ -120,7 +126,7 @@ def create_update_fn(model, config):
     logging.info(msg=f'images in loss_fn = {jnp.shape(images)}')
     logging.info(msg=f'labels in loss_fn = {jnp.shape(labels)}')
     def loss_fn(params, images, labels):
-      logits, _ = model.apply({'params': flax.core.freeze(params)},
+      logits, _ = model.apply({'params': params},
                               images,
                               train=True,
                               rngs={'dropout': rng_local})
@@ -140,26 +146,22 @@ def create_update_fn(model, config):
     measurements['training_loss'] = l
     logging.info(msg=f'measurements = {measurements}')
 
-    # Log the gradient norm only if we need to compute it anyways (clipping)
-    # or if we don't use grad_accum_steps, as they interact badly.
-    if config.get('grad_accum_steps', 1) == 1 or config.get('grad_clip_norm'):
-      grads, _ = jax.tree_flatten(g)
-      l2_g = jnp.sqrt(sum([jnp.vdot(p, p) for p in grads]))
-      measurements['l2_grads'] = l2_g
-    logging.info(msg=f'measurements = {measurements}')
+    # Unlike in deterministic.py (see the contract in its update_fn), the
+    # gradient norm is only computed when clipping needs it, and the parameter
+    # norm not at all: the active learning loop does not log them, and each norm
+    # is an extra pass over all parameters per step.
 
     # Optionally resize the global gradient to a maximum norm. We found this
     # useful in some cases across optimizers, hence it's in the main loop.
     if config.get('grad_clip_norm'):
+      l2_g = _tree_l2_norm(g)
+      measurements['l2_grads'] = l2_g
       g_factor = jnp.minimum(1.0, config.grad_clip_norm / l2_g)
       g = jax.tree_util.tree_map(lambda p: g_factor * p, g)
     opt = opt.apply_gradient(g, learning_rate=lr)
 
     opt = opt.replace(target=weight_decay_fn(opt.target, lr))
 
-    params, _ = jax.tree_flatten(opt.target)
-    measurements['l2_params'] = jnp.sqrt(sum([jnp.vdot(p, p) for p in params]))
-
     top1_idx = jnp.argmax(logits, axis=1)
     top1_correct = jnp.take_along_axis(labels, top1_idx[:, None], axis=1)[:, 0]
     prec1 = jax.lax.psum(
@@ -171,12 +173,16 @@ def create_update_fn(model, config):
   return update_fn
 
 
-def create_evaluation_fn(model, config):
+def create_evaluation_fn(model, config, gather_metric_args=True):
   """Create the evaluation function from model and config.
 
   Args:
     model: The model to be used in updates.
     config: The config of the experiment.
+    gather_metric_args: Whether to gather and return the metric_args (logits,
+      labels, pre logits and masks). If False, None is returned in their place,
+      which saves gathering them across devices when only the accuracy or loss
+      is needed.
 
   Returns:
     The function that evaluates the model for one step.
@@ -185,7 +191,7 @@ def create_evaluation_fn(model, config):
   def evaluation_fn(params, images, labels, mask):
     # Ignore the entries with all zero labels for evaluation.
     mask *= labels.max(axis=1)
-    logits, out = model.apply({'params': flax.core.freeze(params)},
+    logits, out = model.apply({'params': params},
                               images,
                               train=False)
     label_indices = config.get('label_indices')
@@ -211,6 +217,9 @@ def create_evaluation_fn(model, config):
     ncorrect = jax.lax.psum(top1_correct * mask, axis_name='batch')
     n = jax.lax.psum(mask, axis_name='batch')
 
+    if not gather_metric_args:
+      return ncorrect, loss, n, None
+
     metric_args = jax.lax.all_gather([logits, labels, out['pre_logits'], mask],
                                      axis_name='batch')
     return ncorrect, loss, n, metric_args
@@ -53,11 +53,13 @@ def get_config():
   config.pp_eval = ''  # set in sweep
 
   config.shuffle_buffer_size = 50_000  # Per host, so small-ish is ok.
+  config.cache_pool = False  # The pool set can be larger than host memory.
 
   config.log_training_steps = 100
   config.log_eval_steps = 1000
   config.checkpoint_steps = 5000
   config.checkpoint_timeout = 1
+  config.checkpoint_rounds = None  # Checkpoint every N fine-tuning rounds.
 
   config.prefetch_to_device = 2
   config.trial = 0
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 """Input pipeline utilities for the ViT experiments."""
+import itertools
 import math
 from typing import Callable, Optional, Union
 
@@ -125,6 +126,56 @@ def get_num_examples(dataset: Union[str, tfds.core.DatasetBuilder,
   return num_examples
 
 
+def get_num_batches(dataset: Union[str, tfds.core.DatasetBuilder,
+                                   SubsetDatasetBuilder],
+                    split: str,
+                    process_batch_size: int,
+                    drop_remainder: bool = True,
+                    process_index: Optional[int] = None,
+                    process_count: Optional[int] = None,
+                    data_dir: Optional[str] = None) -> int:
+  """Returns the number of batches in one epoch of `get_data` for a process.
+
+  Args:
+    dataset: Either a dataset name or a dataset builder object.
+    split: Specifies which split of the data to load.
+    process_batch_size: Per process batch size.
+    drop_remainder: Whether to drop remainders when sharding across processes
+      and batching.
+    process_index: Integer id in the range [0, process_count) of the current
+      process in a multi-process setup. If None, then the index will be obtained
+      from `jax.process_index()`.
+    process_count: Number of global processes (over all "hosts") across
+      which the dataset will be sharded. If None, then the number of global
+      processes will be obtained from `jax.process_count()`.
+    data_dir: Directory for the dataset files.
+
+  Returns:
+    The number of batches that `get_data` yields per epoch of the split for the
+    given process, including the last padded batch if not dropping remainders.
+  """
+  dataset_builder = _get_dataset_builder(dataset, data_dir)
+  if process_index is None:
+    process_index = jax.process_index()
+  if process_count is None:
+    process_count = jax.process_count()
+
+  num_examples = _get_process_num_examples(
+      dataset_builder,
+      split=split,
+      process_batch_size=process_batch_size,
+      process_index=process_index,
+      process_count=process_count,
+      drop_remainder=drop_remainder)
+
+  # Mirrors the batching in `get_data`.
+  num_devices = jax.local_device_count()
+  if drop_remainder:
+    return num_examples // (process_batch_size // num_devices * num_devices)
+  flat_batch_size = math.ceil(process_batch_size / num_devices) * num_devices
+  return math.ceil(num_examples / flat_batch_size)
+
+
 def _add_mask(batch, num_batch_dims):
   """Adds a mask to a dictionary of tensors."""
   mask = tf.ones(tf.shape(list(batch.values())[0])[:num_batch_dims])
@@ -294,3 +345,36 @@ def start_input_pipeline(dataset, n_prefetch, devices=None):
   if n_prefetch:
     it = flax.jax_utils.prefetch_to_device(it, n_prefetch, devices=devices)
   return it
+
+
+def start_epoch_input_pipeline(dataset, num_batches, n_prefetch, devices=None):
+  """Creates a long-lived data iterator over a repeated dataset.
+
+  Creating a new iterator for every pass over a small dataset pays the start-up
+  cost of the tf.data pipeline every time. The host iterator created here is
+  kept alive instead, and every epoch takes the next `num_batches` batches from
+  it. Prefetching to the devices is done per epoch, such that no batches are
+  left on the devices in between epochs.
+
+  Args:
+    dataset: A dataset that repeats forever after batching, e.g. `get_data`
+      with `num_epochs=None` and `repeat_after_batching=True`.
+    num_batches: The number of batches in an epoch of `dataset`, see
+      `get_num_batches`. If this does not match the dataset, epochs will not
+      start at the beginning of the dataset.
+    n_prefetch: Number of batches to prefetch to the devices.
+    devices: The devices to prefetch to.
+
+  Returns:
+    A function that returns an iterator over the next epoch of `dataset`.
+  """
+  it = start_input_pipeline(dataset, n_prefetch=0)
+
+  def start_epoch():
+    epoch_it = itertools.islice(it, num_batches)
+    if n_prefetch:
+      epoch_it = flax.jax_utils.prefetch_to_device(
+          epoch_it, n_prefetch, devices=devices)
+    return epoch_it
+
+  return start_epoch
@@ -21,6 +21,7 @@ import pathlib
 from absl import logging
 from absl.testing import parameterized
 import jax
+import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import input_utils  # local file import from baselines.jft
@@ -204,6 +205,53 @@ class InputUtilsTest(parameterized.TestCase, tf.test.TestCase):
     self.assertAllClose(val_image_sum, correct_val_image_sum)
     self.assertAllClose(val_labels_sum, correct_val_labels_sum)
 
+  @parameterized.parameters(0, 2)
+  def test_start_epoch_input_pipeline(self, n_prefetch):
+    dataset = "imagenet2012"
+    split = "validation[:10]"
+    process_batch_size = 3 * jax.local_device_count()
+
+    def preprocess_fn(example):
+      return {
+          "id": tf.strings.to_hash_bucket_fast(example["file_name"], 2**31 - 1)
+      }
+
+    with tfds.testing.mock_data(num_examples=10, data_dir=self.data_dir):
+      ds = input_utils.get_data(
+          dataset,
+          split=split,
+          rng=None,
+          process_batch_size=process_batch_size,
+          preprocess_fn=preprocess_fn,
+          num_epochs=None,
+          repeat_after_batching=True,
+          shuffle=False,
+          prefetch_size=2,
+          drop_remainder=False,
+          data_dir=self.data_dir)
+      num_batches = input_utils.get_num_batches(
+          dataset,
+          split=split,
+          process_batch_size=process_batch_size,
+          drop_remainder=False,
+          data_dir=self.data_dir)
+      start_epoch = input_utils.start_epoch_input_pipeline(
+          ds, num_batches, n_prefetch=n_prefetch)
+
+      def get_epoch_ids():
+        batches = list(start_epoch())
+        ids = np.concatenate([np.ravel(batch["id"]) for batch in batches])
+        masks = np.concatenate([np.ravel(batch["mask"]) for batch in batches])
+        return ids[masks.astype(bool)]
+
+      first_epoch_ids = get_epoch_ids()
+      second_epoch_ids = get_epoch_ids()
+
+    # The last batch is padded, and all examples are seen exactly once.
+    self.assertEqual(num_batches, -(-10 // process_batch_size))
+    self.assertLen(np.unique(first_epoch_ids), 10)
+    self.assertAllEqual(first_epoch_ids, second_epoch_ids)
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -253,10 +253,12 @@ def compute_mahalanobis_distance(embeds, mean_list, cov, epsilon=1e-20):
   vi = np.linalg.inv(v)
   means = np.array(mean_list)
 
+  # Compute the distances of all samples to one class at a time, which only
+  # needs the diagonal of (x - m) vi (x - m)^T.
   out = np.zeros((n_sample, n_class))
-  for i in range(n_sample):
-    x = embeds[i]
-    out[i, :] = np.diag(np.dot(np.dot((x - means), vi), (x - means).T))
+  for j in range(n_class):
+    diff = embeds - means[j]
+    out[:, j] = np.sum(np.dot(diff, vi) * diff, axis=-1)
   return out
 
 
@@ -69,6 +69,15 @@ class OodUtilsTest(parameterized.TestCase):
                                                    self.cov)
     np.testing.assert_array_equal(np.array([0, 0, 81]), np.min(dists, axis=-1))
 
+  def test_compute_mahalanobis_distance_matches_per_sample(self):
+    embeds = np.random.normal(size=(10, 2))
+    cov = np.array([[2., 0.5], [0.5, 1.]])
+    dists = ood_utils.compute_mahalanobis_distance(embeds, self.mean_list, cov)
+    vi = np.linalg.inv(cov)
+    for i, x in enumerate(embeds):
+      for j, m in enumerate(self.mean_list):
+        np.testing.assert_allclose(dists[i, j], (x - m) @ vi @ (x - m))
+
 
 if __name__ == "__main__":
   absltest.main()